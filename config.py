@@ -2,21 +2,47 @@
 Konfiguration och konstanter för löparruttplaneraren
 """
 
+import os
+
 # Standardvärden
 DEFAULT_DISTANCE = 5.0
 DEFAULT_TOLERANCE = 5.0
 DEFAULT_PACE = "5:30"
-DEFAULT_CENTER = [59.3293, 18.0686]  # Stockholm
+DEFAULT_CENTER = (59.3293, 18.0686)  # Stockholm
+
+# Gränssnittsval
+USE_SURFACE_PREFERENCE = os.getenv("RR_SURFACE", "1") == "1"  # RR_SURFACE=0 döljer underlagsval
+AUTO_GEOCODE = True  # Geokoda när adressen ändras, annars via knappen "Sök adress"
+FIXED_TOLERANCE = 5.0  # Fast tolerans i procent, None visar ett reglage
 
 # API URLs
 ORS_BASE_URL = "https://api.openrouteservice.org"
 GRAPHHOPPER_BASE_URL = "https://graphhopper.com/api/1"
 NOMINATIM_BASE_URL = "https://nominatim.openstreetmap.org"
-MAPBOX_BASE_URL = "https://api.mapbox.com/geocoding/v6"
+MAPBOX_BASE_URL = "https://api.mapbox.com/search/geocode/v6"
+
+# Geokodning
+NOMINATIM_MIN_INTERVAL = 1.0  # Nominatims policy: max 1 anrop per sekund
+NOMINATIM_MAX_BACKOFF = 60.0  # Längsta Retry-After (sekunder) som följs vid 429
+GEOCODE_CACHE_PATH = ".geocode_cache.sqlite"
+GEOCODE_CACHE_TTL = 7 * 24 * 3600  # 1 vecka
+USE_MAPBOX = os.getenv("RR_MAPBOX", "0") == "1"  # RR_MAPBOX=1 geokodar via Mapbox (kräver MAPBOX_TOKEN)
+GEOCODE_NEGATIVE_TTL = 600  # Adresser som inte hittades, 10 minuter
+GEOCODE_MEMORY_TTL = 24 * 3600  # st.cache_data i processen, 1 dygn
+MIN_GEOCODE_QUERY_LENGTH = 4  # Kortare adresser skickas inte till geokodning
+GEOCODE_INLINE_WAIT = 0.1  # Sekunder att vänta på geokodning innan sidan ritas
+GEOCODE_POLL_INTERVAL = 0.5  # Sekunder mellan kontroller av pågående geokodning
+GEOCODE_CLICK_WAIT = 5.0  # Längsta väntan på pågående geokodning vid "Generera rutt"
 
 # Routing-inställningar
 MAX_ROUTE_ATTEMPTS = 10
 PERFECT_TOLERANCE_PERCENT = 1.0  # Sluta söka om vi hittar rutt inom 1%
+ROUTE_ATTEMPT_WORKERS = 4  # Samtidiga ruttförsök per provider
+
+# Kartvisning
+MAP_SIMPLIFY_TOLERANCE = 1e-5  # Grader (~1 m), förenkling av polylinjen på kartan
+MAP_SIMPLIFY_MIN_POINTS = 500  # Kortare rutter visas oförenklade
 
 # Cache-inställningar
-CACHE_TTL = 3600  # 1 timme
\ No newline at end of file
+CACHE_TTL = 3600  # 1 timme
+ROUTE_CACHE_PATH = ".route_cache.sqlite"  # Rutter på disk, samma TTL som CACHE_TTL
\ No newline at end of file
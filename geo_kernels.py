@@ -0,0 +1,48 @@
+"""
+Kompilerade beräkningskärnor för långa rutter (kräver numba, valfritt)
+"""
+
+import math
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Jordens radie i meter
+_EARTH_RADIUS = 6371000.0
+# Segment kortare än ~1 km räknas med ekvirektangulär approximation
+_SHORT_SEGMENT = 1000.0 / _EARTH_RADIUS
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def haversine_total(lats, lons):
+        """
+        Total distans i meter längs en rutt
+        
+        Korta segment (typiskt mellan två ruttpunkter) räknas ekvirektangulärt
+        utan asin, längre segment med Haversine.
+        
+        Args:
+            lats: Latituder i grader (float64-array)
+            lons: Longituder i grader (float64-array)
+        
+        Returns:
+            Total distans i meter
+        """
+        total = 0.0
+        for i in range(len(lats) - 1):
+            lat1 = math.radians(lats[i])
+            lat2 = math.radians(lats[i + 1])
+            dlat = lat2 - lat1
+            dlon = math.radians(lons[i + 1] - lons[i])
+            
+            x = dlon * math.cos(0.5 * (lat1 + lat2))
+            if abs(dlat) < _SHORT_SEGMENT and abs(x) < _SHORT_SEGMENT:
+                total += math.sqrt(x * x + dlat * dlat)
+            else:
+                a = math.sin(dlat * 0.5) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon * 0.5) ** 2
+                total += 2.0 * math.asin(math.sqrt(a))
+        return total * _EARTH_RADIUS
+else:
+    haversine_total = None
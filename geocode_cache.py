@@ -0,0 +1,123 @@
+"""
+Persistent SQLite-cache för geokodningsresultat som överlever omstarter
+"""
+
+import sqlite3
+import time
+from typing import Optional, Tuple
+from sqlite_cache import SharedConnection
+from config import GEOCODE_CACHE_PATH, GEOCODE_CACHE_TTL, GEOCODE_NEGATIVE_TTL
+
+# Anslutningen delas mellan trådarna, all åtkomst går via _db.lock
+_db = SharedConnection(
+    GEOCODE_CACHE_PATH,
+    "CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, lat REAL, lon REAL, ts REAL)",
+    "CREATE TABLE IF NOT EXISTS reverse (key TEXT PRIMARY KEY, address TEXT, ts REAL)"
+)
+
+def normalize_address(address: str) -> str:
+    """Normalisera adress till cache-nyckel (gemener, enkla mellanslag)"""
+    return " ".join(address.lower().split())
+
+def reverse_key(lat: float, lon: float) -> str:
+    """Skapa cache-nyckel för omvänd geokodning (~11 m precision)"""
+    return f"{lat:.4f},{lon:.4f}"
+
+def get_coordinates(key: str) -> Optional[Tuple[float, float]]:
+    """
+    Hämta cachade koordinater
+    
+    Args:
+        key: Normaliserad adress
+    
+    Returns:
+        (lat, lon) eller None om nyckeln saknas eller är för gammal
+    """
+    try:
+        with _db.lock:
+            row = _db.connect().execute(
+                "SELECT lat, lon FROM geocode WHERE key = ? AND lat IS NOT NULL AND ts > ?",
+                (key, time.time() - GEOCODE_CACHE_TTL)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    return (row[0], row[1]) if row else None
+
+def set_coordinates(key: str, coords: Tuple[float, float]):
+    """Spara koordinater för en normaliserad adress"""
+    try:
+        with _db.lock:
+            conn = _db.connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO geocode (key, lat, lon, ts) VALUES (?, ?, ?, ?)",
+                    (key, coords[0], coords[1], time.time())
+                )
+    except sqlite3.Error:
+        pass
+
+def is_known_missing(key: str) -> bool:
+    """
+    Kontrollera om adressen nyligen gav noll träffar
+    
+    Args:
+        key: Normaliserad adress
+    
+    Returns:
+        True om en negativ post finns inom GEOCODE_NEGATIVE_TTL
+    """
+    try:
+        with _db.lock:
+            row = _db.connect().execute(
+                "SELECT 1 FROM geocode WHERE key = ? AND lat IS NULL AND ts > ?",
+                (key, time.time() - GEOCODE_NEGATIVE_TTL)
+            ).fetchone()
+    except sqlite3.Error:
+        return False
+    return row is not None
+
+def set_missing(key: str):
+    """Spara att adressen inte hittades (negativ post)"""
+    try:
+        with _db.lock:
+            conn = _db.connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO geocode (key, lat, lon, ts) VALUES (?, NULL, NULL, ?)",
+                    (key, time.time())
+                )
+    except sqlite3.Error:
+        pass
+
+def get_address(key: str) -> Optional[str]:
+    """
+    Hämta cachad adress för omvänd geokodning
+    
+    Args:
+        key: Nyckel från reverse_key
+    
+    Returns:
+        Adress eller None om nyckeln saknas eller är för gammal
+    """
+    try:
+        with _db.lock:
+            row = _db.connect().execute(
+                "SELECT address FROM reverse WHERE key = ? AND ts > ?",
+                (key, time.time() - GEOCODE_CACHE_TTL)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+def set_address(key: str, address: str):
+    """Spara adress för omvänd geokodning"""
+    try:
+        with _db.lock:
+            conn = _db.connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO reverse (key, address, ts) VALUES (?, ?, ?)",
+                    (key, address, time.time())
+                )
+    except sqlite3.Error:
+        pass
@@ -4,60 +4,366 @@ Geokodningsfunktioner för att konvertera mellan adresser och koordinater
 
 import streamlit as st
 import requests
+import re
 import time
-from typing import Optional, Tuple
-from config import NOMINATIM_BASE_URL, MAPBOX_BASE_URL, CACHE_TTL
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import List, Optional, Tuple
+
+try:
+    import orjson as _json  # Snabbare JSON-parsning om tillgängligt
+except ImportError:
+    import json as _json
+
+try:
+    import msgspec  # Typad JSON-avkodning om tillgängligt
+except ImportError:
+    msgspec = None
+
+from config import (
+    NOMINATIM_BASE_URL,
+    MAPBOX_BASE_URL,
+    NOMINATIM_MIN_INTERVAL,
+    NOMINATIM_MAX_BACKOFF,
+    GEOCODE_MEMORY_TTL,
+    USE_MAPBOX
+)
+from geocode_cache import (
+    normalize_address,
+    reverse_key,
+    get_coordinates,
+    set_coordinates,
+    is_known_missing,
+    set_missing,
+    get_address,
+    set_address
+)
+
+# Delad session så att HTTPS-anslutningen till Nominatim/Mapbox återanvänds.
+# Adaptern försöker bara om GET-anrop som aldrig nådde servern (anslutningsfel);
+# omförsök efter serversvar går via _nominatim_get så att de tar en plats i
+# Nominatims anropsgräns. Rate limit (429) försöks inte om, Retry-After flyttar
+# istället fram nästa anropstid.
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": "StreamlitRunningApp/1.0"})
+_retry = Retry(
+    total=2,
+    connect=2,
+    read=0,
+    status=0,
+    backoff_factor=0.3,
+    allowed_methods=("GET",)
+)
+
+# Tillfälliga serverfel som försöks om via anropsgränsen, och antal omförsök
+_NOMINATIM_RETRY_STATUS = (502, 503, 504)
+_NOMINATIM_RETRIES = 2
+_SESSION.mount("https://", HTTPAdapter(max_retries=_retry, pool_connections=4, pool_maxsize=8))
+
+# Inmatning som redan är koordinater, t.ex. "59.3293, 18.0686"
+_LL_RE = re.compile(r"^\s*(-?\d+(?:\.\d+)?)[,\s]+(-?\d+(?:\.\d+)?)\s*$")
+
+# Token och URL:er beräknas en gång vid import istället för per anrop
+try:
+    _MAPBOX_TOKEN = st.secrets.get("MAPBOX_TOKEN")
+except Exception:
+    _MAPBOX_TOKEN = None
+_NOM_SEARCH = f"{NOMINATIM_BASE_URL}/search"
+_NOM_REVERSE = f"{NOMINATIM_BASE_URL}/reverse"
+_MAPBOX_FORWARD = f"{MAPBOX_BASE_URL}/forward"
+_MAPBOX_BATCH = f"{MAPBOX_BASE_URL}/batch"
+
+# Mapbox används bara när USE_MAPBOX är satt och en token är konfigurerad
+MAPBOX_ENABLED = USE_MAPBOX and bool(_MAPBOX_TOKEN)
+
+# Tidpunkt (time.monotonic) för senast reserverade Nominatim-anrop, lista för mutabilitet
+_last_nominatim_call = [0.0]
+# Skyddar reservationen av anropstider när adresser geokodas parallellt
+_nominatim_lock = threading.Lock()
+
+if msgspec is not None:
+    class NominatimHit(msgspec.Struct):
+        """Träff från Nominatim /search"""
+        lat: str
+        lon: str
+    
+    class ReverseHit(msgspec.Struct):
+        """Svar från Nominatim /reverse"""
+        display_name: Optional[str] = None
+    
+    class MapboxGeometry(msgspec.Struct):
+        coordinates: List[float]
+    
+    class MapboxFeature(msgspec.Struct):
+        geometry: MapboxGeometry
+    
+    class MapboxCollection(msgspec.Struct):
+        """FeatureCollection från Mapbox"""
+        features: List[MapboxFeature] = []
+    
+    class MapboxBatch(msgspec.Struct):
+        batch: List[MapboxCollection] = []
+    
+    _SEARCH_DECODER = msgspec.json.Decoder(List[NominatimHit])
+    _REVERSE_DECODER = msgspec.json.Decoder(ReverseHit)
+    _MAPBOX_DECODER = msgspec.json.Decoder(MapboxCollection)
+    _MAPBOX_BATCH_DECODER = msgspec.json.Decoder(MapboxBatch)
+
+# Fel som kan uppstå vid avkodning av svaren
+_DECODE_ERRORS = (ValueError, msgspec.DecodeError) if msgspec is not None else (ValueError,)
+
+def _decode_search(content: bytes) -> Optional[Tuple[float, float]]:
+    """Avkoda Nominatim /search-svar till (lat, lon)"""
+    if msgspec is not None:
+        hits = _SEARCH_DECODER.decode(content)
+        return (float(hits[0].lat), float(hits[0].lon)) if hits else None
+    data = _json.loads(content)
+    return (float(data[0]["lat"]), float(data[0]["lon"])) if data else None
+
+def _decode_reverse(content: bytes) -> Optional[str]:
+    """Avkoda Nominatim /reverse-svar till adress"""
+    if msgspec is not None:
+        return _REVERSE_DECODER.decode(content).display_name
+    return _json.loads(content).get("display_name")
+
+def _first_mapbox_coords(collection) -> Optional[Tuple[float, float]]:
+    """Koordinater för första träffen i en Mapbox FeatureCollection"""
+    if msgspec is not None:
+        if not collection.features:
+            return None
+        lon, lat = collection.features[0].geometry.coordinates[:2]
+    else:
+        features = collection.get("features") or []
+        if not features:
+            return None
+        lon, lat = features[0]["geometry"]["coordinates"][:2]
+    return lat, lon
+
+def _decode_mapbox(content: bytes) -> Optional[Tuple[float, float]]:
+    """Avkoda Mapbox-svar till (lat, lon)"""
+    if msgspec is not None:
+        return _first_mapbox_coords(_MAPBOX_DECODER.decode(content))
+    return _first_mapbox_coords(_json.loads(content))
+
+def _decode_mapbox_batch(content: bytes) -> List[Optional[Tuple[float, float]]]:
+    """Avkoda Mapbox batch-svar till en lista med (lat, lon)"""
+    if msgspec is not None:
+        batch = _MAPBOX_BATCH_DECODER.decode(content).batch
+    else:
+        batch = _json.loads(content).get("batch", [])
+    return [_first_mapbox_coords(collection) for collection in batch]
+
+def _wait_for_nominatim():
+    """
+    Reservera nästa lediga Nominatim-tid och vänta endast tills den infaller
+    
+    Låset hålls bara under reservationen, inte under väntan eller själva
+    anropet, så samtidiga anrop sprids ut med NOMINATIM_MIN_INTERVAL.
+    """
+    with _nominatim_lock:
+        now = time.monotonic()
+        slot = max(now, _last_nominatim_call[0] + NOMINATIM_MIN_INTERVAL)
+        _last_nominatim_call[0] = slot
+    if slot > now:
+        time.sleep(slot - now)
+
+def _respect_retry_after(response: requests.Response):
+    """Skjut upp nästa Nominatim-anrop enligt Retry-After när servern svarar 429"""
+    if response.status_code != 429:
+        return
+    try:
+        delay = float(response.headers.get("Retry-After", NOMINATIM_MIN_INTERVAL))
+    except ValueError:
+        # HTTP-datum tolkas inte, vänta ett extra intervall istället
+        delay = NOMINATIM_MIN_INTERVAL
+    delay = min(max(delay, NOMINATIM_MIN_INTERVAL), NOMINATIM_MAX_BACKOFF)
+    with _nominatim_lock:
+        # Nästa reservation hamnar NOMINATIM_MIN_INTERVAL efter den här tiden
+        earliest = time.monotonic() + delay - NOMINATIM_MIN_INTERVAL
+        _last_nominatim_call[0] = max(_last_nominatim_call[0], earliest)
+
+def _nominatim_get(url: str, params: dict) -> requests.Response:
+    """
+    GET mot Nominatim där varje försök, även omförsök, väntar in anropsgränsen
+    
+    Tillfälliga serverfel (502/503/504) försöks om upp till _NOMINATIM_RETRIES
+    gånger; det sista svaret returneras oavsett status.
+    """
+    for attempt in range(_NOMINATIM_RETRIES + 1):
+        _wait_for_nominatim()
+        response = _SESSION.get(url, params=params, timeout=10)
+        _respect_retry_after(response)
+        if response.status_code not in _NOMINATIM_RETRY_STATUS or attempt == _NOMINATIM_RETRIES:
+            return response
+        response.close()
+
+def _parse_lat_lon(address: str) -> Optional[Tuple[float, float]]:
+    """Tolka "lat, lon" direkt utan nätverksanrop"""
+    m = _LL_RE.match(address)
+    if m:
+        lat, lon = float(m.group(1)), float(m.group(2))
+        # Intervallkontrollen görs här istället för via utils.validate_coordinates,
+        # så att utils (och numba) inte laddas när appen startar
+        if -90 <= lat <= 90 and -180 <= lon <= 180:
+            return lat, lon
+    return None
 
-@st.cache_data(ttl=CACHE_TTL)
 def geocode_address(address: str, use_mapbox: bool = False) -> Optional[Tuple[float, float]]:
     """
     Geokoda en adress till koordinater
     
+    Adressen normaliseras (gemener, enkla mellanslag) innan cache-uppslag så
+    att "Kungsgatan 1" och " kungsgatan  1" delar cache-post.
+    
     Args:
         address: Adress att geokoda
-        use_mapbox: Använd Mapbox istället för Nominatim
+        use_mapbox: Använd Mapbox istället för Nominatim (kräver USE_MAPBOX och MAPBOX_TOKEN)
     
     Returns:
-        (lat, lon) eller None vid fel
+        (lat, lon) eller None om adressen inte hittades. Nätverks- och
+        HTTP-fel samt ogiltiga svar kastas som requests.RequestException
+    """
+    coords = _parse_lat_lon(address)
+    if coords:
+        return coords
+    try:
+        return _geocode_normalized(normalize_address(address), use_mapbox and MAPBOX_ENABLED)
+    except _NotFound:
+        return None
+
+class _NotFound(Exception):
+    """Signalerar att geokodningen misslyckades, så att None inte cachas i minnet"""
+
+@st.cache_data(ttl=GEOCODE_MEMORY_TTL, max_entries=1024, show_spinner=False)
+def _geocode_normalized(address: str, use_mapbox: bool = False) -> Tuple[float, float]:
+    """
+    Geokoda en redan normaliserad adress
+    
+    Adresser som inte gav någon träff sparas som negativ post en kort tid
+    så att upprepade försök inte går mot API:t igen. Nätverks- och HTTP-fel
+    samt svar som inte kan avkodas sparas inte utan kastas vidare till
+    anroparen som requests.RequestException.
+    """
+    cache_key = address
+    if use_mapbox:
+        # Mapbox temporära geokodning får inte lagras, så bara Nominatims
+        # träffar sparas på disk; negativa poster innehåller inget resultat
+        cache_key = f"mapbox:{cache_key}"
+    else:
+        cached = get_coordinates(cache_key)
+        if cached:
+            return cached
+    if is_known_missing(cache_key):
+        raise _NotFound()
+    
+    # Nätverks- och HTTP-fel kastas vidare: geokodningen körs i en
+    # bakgrundstråd där st.error inte syns, så anroparen visar felet
+    if use_mapbox:
+        params = {
+            "q": address,
+            "access_token": _MAPBOX_TOKEN,
+            "limit": 1
+        }
+        response = _SESSION.get(_MAPBOX_FORWARD, params=params, timeout=10)
+        decode = _decode_mapbox
+    else:
+        # Använd Nominatim
+        params = {
+            "q": address,
+            "format": "json",
+            "limit": 1
+        }
+        response = _nominatim_get(_NOM_SEARCH, params)
+        decode = _decode_search
+    response.raise_for_status()
+    try:
+        coords = decode(response.content)
+    except _DECODE_ERRORS as e:
+        # Ogiltigt svar rapporteras som övriga fel från tjänsten
+        raise requests.exceptions.InvalidJSONError(str(e), response=response) from e
+    
+    if coords:
+        if not use_mapbox:
+            set_coordinates(cache_key, coords)
+        return coords
+    set_missing(cache_key)
+    raise _NotFound()
+
+def _mapbox_batch(addresses: List[str]) -> Optional[List[Optional[Tuple[float, float]]]]:
     """
+    Geokoda flera adresser med ett enda anrop mot Mapbox batch-endpoint
+    
+    Träffarna sparas inte på disk (Mapbox temporära geokodning), bara
+    adresser som saknade träff sparas som negativ post.
+    """
+    keys = [f"mapbox:{normalize_address(address)}" for address in addresses]
+    results = [_parse_lat_lon(address) for address in addresses]
+    # Adresser som nyligen saknade träff skickas inte igen
+    misses = [
+        i for i, coords in enumerate(results)
+        if coords is None and not is_known_missing(keys[i])
+    ]
+    if not misses:
+        return results
+    
     try:
-        if use_mapbox and "MAPBOX_TOKEN" in st.secrets:
-            url = f"{MAPBOX_BASE_URL}/mapbox.places/{address}.json"
-            params = {
-                "access_token": st.secrets["MAPBOX_TOKEN"],
-                "limit": 1
-            }
-            response = requests.get(url, params=params, timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                if data.get("features"):
-                    coords = data["features"][0]["geometry"]["coordinates"]
-                    return coords[1], coords[0]  # lon, lat -> lat, lon
+        response = _SESSION.post(
+            _MAPBOX_BATCH,
+            params={"access_token": _MAPBOX_TOKEN},
+            json=[{"q": addresses[i], "limit": 1} for i in misses],
+            timeout=10
+        )
+        if response.status_code != 200:
+            return None
+        batch = _decode_mapbox_batch(response.content)
+    except (requests.RequestException, *_DECODE_ERRORS):
+        return None
+    
+    for i, coords in zip(misses, batch):
+        if coords:
+            results[i] = coords
         else:
-            # Använd Nominatim
-            url = f"{NOMINATIM_BASE_URL}/search"
-            params = {
-                "q": address,
-                "format": "json",
-                "limit": 1
-            }
-            headers = {"User-Agent": "StreamlitRunningApp/1.0"}
-            response = requests.get(url, params=params, headers=headers, timeout=10)
-            time.sleep(1)  # Rate limiting för Nominatim
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data:
-                    return float(data[0]["lat"]), float(data[0]["lon"])
-    except Exception as e:
-        st.error(f"Geokodningsfel: {str(e)}")
-    return None
+            set_missing(keys[i])
+    return results
+
+def geocode_addresses(
+    addresses: List[str],
+    use_mapbox: bool = False
+) -> List[Optional[Tuple[float, float]]]:
+    """
+    Geokoda flera adresser på en gång
+    
+    Med Mapbox skickas alla adresser i ett batch-anrop, annars geokodas
+    de parallellt via geocode_address.
+    
+    Args:
+        addresses: Adresser att geokoda
+        use_mapbox: Använd Mapbox istället för Nominatim (kräver USE_MAPBOX och MAPBOX_TOKEN)
+    
+    Returns:
+        Lista med (lat, lon) eller None, i samma ordning som addresses
+    """
+    use_mapbox = use_mapbox and MAPBOX_ENABLED
+    if use_mapbox and len(addresses) > 1:
+        results = _mapbox_batch(addresses)
+        if results is not None:
+            return results
+    
+    if len(addresses) <= 1:
+        return [geocode_address(address, use_mapbox) for address in addresses]
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        return list(executor.map(lambda address: geocode_address(address, use_mapbox), addresses))
 
-@st.cache_data(ttl=CACHE_TTL)
 def reverse_geocode(lat: float, lon: float) -> Optional[str]:
     """
     Omvänd geokodning - koordinater till adress
     
+    Koordinaterna avrundas till 4 decimaler (~11 m) så att närliggande
+    kartklick delar cache-post.
+    
     Args:
         lat: Latitud
         lon: Longitud
@@ -66,19 +372,37 @@ def reverse_geocode(lat: float, lon: float) -> Optional[str]:
         Adress eller None vid fel
     """
     try:
-        url = f"{NOMINATIM_BASE_URL}/reverse"
+        return _reverse_geocode_quantized(round(lat, 4), round(lon, 4))
+    except _NotFound:
+        # Misslyckade uppslag sparas inte, så att nästa anrop försöker igen
+        return None
+
+@st.cache_data(ttl=GEOCODE_MEMORY_TTL, max_entries=1024, show_spinner=False)
+def _reverse_geocode_quantized(lat: float, lon: float) -> str:
+    """
+    Omvänd geokodning för redan avrundade koordinater
+    
+    Nätverksfel och felsvar ger _NotFound istället för None, så att
+    misslyckandet inte memoiseras av st.cache_data.
+    """
+    cache_key = reverse_key(lat, lon)
+    cached = get_address(cache_key)
+    if cached:
+        return cached
+    
+    try:
         params = {
             "lat": lat,
             "lon": lon,
             "format": "json"
         }
-        headers = {"User-Agent": "StreamlitRunningApp/1.0"}
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        time.sleep(1)  # Rate limiting
+        response = _nominatim_get(_NOM_REVERSE, params)
         
         if response.status_code == 200:
-            data = response.json()
-            return data.get("display_name", "Okänd plats")
-    except:
+            address = _decode_reverse(response.content)
+            if address:
+                set_address(cache_key, address)
+            return address or "Okänd plats"
+    except (requests.RequestException, *_DECODE_ERRORS):
         pass
-    return None
\ No newline at end of file
+    raise _NotFound()
@@ -3,41 +3,220 @@ Huvudapplikation för Streamlit löparruttplanerare
 """
 
 import streamlit as st
-from streamlit_folium import st_folium
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
 import hashlib
+from requests import RequestException
 
 # Importera moduler
-from config import DEFAULT_DISTANCE, DEFAULT_TOLERANCE, DEFAULT_PACE, DEFAULT_CENTER
-from geocoding import geocode_address, reverse_geocode
-from routing import get_best_route, create_cache_key
-from map_utils import create_map
-from utils import create_gpx
+from config import (
+    DEFAULT_DISTANCE,
+    DEFAULT_TOLERANCE,
+    DEFAULT_PACE,
+    DEFAULT_CENTER,
+    USE_SURFACE_PREFERENCE,
+    GEOCODE_INLINE_WAIT,
+    GEOCODE_POLL_INTERVAL,
+    GEOCODE_CLICK_WAIT,
+    MIN_GEOCODE_QUERY_LENGTH,
+    AUTO_GEOCODE,
+    FIXED_TOLERANCE,
+    CACHE_TTL
+)
+from geocoding import geocode_addresses, MAPBOX_ENABLED
+from models import RouteInfo
+
+# Visningsnamn för valen i sidomenyn
+_MODE_LABELS = {
+    "loop": "Loop (start = mål)",
+    "point-to-point": "Point-to-point"
+}
+_SURFACE_LABELS = {
+    "any": "Alla underlag",
+    "paved": "Asfalt/vägar",
+    "unpaved": "Grus/naturstigar",
+    "trail": "Skogsstigar"
+}
+_PROVIDER_LABELS = {
+    "auto": "Automatisk (välj bästa)",
+    "ors": "OpenRouteService",
+    "graphhopper": "GraphHopper (ofta mer exakt)",
+    "both": "Testa båda (jämför resultat)"
+}
+
+# Standardvärden för session state
+_DEFAULTS = {
+    "start_coords": None,
+    "end_coords": None,
+    "distance": DEFAULT_DISTANCE,
+    "mode": "loop",
+    "tolerance": DEFAULT_TOLERANCE,
+    "pace": DEFAULT_PACE,
+    "route_info": None,
+    "map_click_mode": "start",
+    "route_seed": 0,
+    "last_start_address": "",
+    "last_end_address": ""
+}
 
 def init_session_state():
-    """Initiera session state"""
-    if "start_coords" not in st.session_state:
-        st.session_state.start_coords = None
-    if "end_coords" not in st.session_state:
-        st.session_state.end_coords = None
-    if "distance" not in st.session_state:
-        st.session_state.distance = DEFAULT_DISTANCE
-    if "mode" not in st.session_state:
-        st.session_state.mode = "loop"
-    if "tolerance" not in st.session_state:
-        st.session_state.tolerance = DEFAULT_TOLERANCE
-    if "pace" not in st.session_state:
-        st.session_state.pace = DEFAULT_PACE
-    if "route_info" not in st.session_state:
-        st.session_state.route_info = None
-    if "map_click_mode" not in st.session_state:
-        st.session_state.map_click_mode = "start"
-    if "route_seed" not in st.session_state:
-        st.session_state.route_seed = 0
-    if "last_start_address" not in st.session_state:
-        st.session_state.last_start_address = ""
-    if "last_end_address" not in st.session_state:
-        st.session_state.last_end_address = ""
+    """Initiera session state, endast vid sessionens första körning"""
+    if st.session_state.get("_init"):
+        return
+    for key, value in _DEFAULTS.items():
+        st.session_state.setdefault(key, value)
+    # Fryst standardnamn så att det inte byts mitt i en session (t.ex. vid midnatt)
+    st.session_state.gpx_default_name = f"Löprunda {datetime.now().strftime('%Y-%m-%d')}"
+    st.session_state["_init"] = True
+
+@st.cache_resource
+def _geocode_executor() -> ThreadPoolExecutor:
+    """
+    Bakgrundstrådar för geokodning, delas mellan sessioner
+    
+    Skriptet körs om från början vid varje omkörning, så exekveraren skapas
+    via cache_resource för att bara finnas en gång per process.
+    """
+    return ThreadPoolExecutor(max_workers=2)
+
+def _route_key(route_info) -> str:
+    """
+    Signatur för en rutt, används som cache-nyckel för kartan
+    
+    Hashar distans, antal punkter och var 16:e koordinat, vilket räcker för
+    att skilja rutter åt utan att gå igenom hela geometrin.
+    """
+    if route_info is None:
+        return ""
+    h = hashlib.blake2b(digest_size=8)
+    h.update(repr((route_info.distance, len(route_info.lats))).encode())
+    h.update(route_info.lats[::16].tobytes())
+    h.update(route_info.lons[::16].tobytes())
+    return h.hexdigest()
+
+@st.cache_resource(max_entries=8, hash_funcs={RouteInfo: _route_key})
+def _cached_map(center_t, route_info, start_t, end_t):
+    """
+    Bygg Folium-kartan endast när dess indata ändrats
+    
+    Folium-objektet cachas som resurs (utan pickling). Rutten hashas via
+    _route_key istället för att Streamlit går igenom hela objektet.
+    """
+    from map_utils import create_map
+    return create_map(center_t, route_info, start_t, end_t)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _gpx_bytes(route_key, name, _route_info):
+    """GPX-filen för en rutt, byggs en gång per (rutt, namn)"""
+    from utils import create_gpx
+    return create_gpx(_route_info, name).encode("utf-8")
+
+class _NoRoute(Exception):
+    """Signalerar att ingen rutt hittades, så att misslyckandet inte cachas"""
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=64, show_spinner=False)
+def _cached_route(start, end, distance, tolerance, mode, seed, provider, surface_preference, pace):
+    """
+    Hämta rutt via get_best_route, memoiserad på sina argument
+    
+    Alla argument är tupler, tal eller strängar som Streamlit hashar direkt,
+    så ingen separat cache-nyckel behöver byggas.
+    """
+    from routing import get_best_route
+    route_info = get_best_route(
+        start, end, distance, tolerance, mode, seed, provider,
+        surface_preference=surface_preference, pace=pace
+    )
+    if route_info is None:
+        raise _NoRoute()
+    return route_info
+
+def _fetch_route(provider, start, end, distance, tolerance, mode, seed, surface_pref, pace):
+    """Hämta rutt från en provider via _cached_route, None om ingen hittades"""
+    try:
+        return _cached_route(
+            start, end if mode == "point-to-point" else None,
+            distance, tolerance, mode, seed, provider, surface_pref, pace
+        )
+    except _NoRoute:
+        return None
+
+def _apply_geocode(job):
+    """Tillämpa resultatet från en avslutad geokodning i bakgrunden"""
+    st.session_state["_pending_geocode"] = None
+    try:
+        results = job["future"].result()
+    except RequestException as e:
+        # Glöm adresserna så att de söks igen vid nästa ändring eller knapptryck
+        for role, _ in job["pending"]:
+            st.session_state[f"last_{role}_address"] = ""
+        st.error(f"Geokodningsfel: {str(e)}")
+        return
+    
+    for (role, address), coords in zip(job["pending"], results):
+        label = "Startpunkt" if role == "start" else "Slutpunkt"
+        if coords:
+            st.session_state[f"{role}_coords"] = coords
+            st.success(f"{label} hittad")
+        else:
+            st.error(f"Kunde inte hitta adressen ({label.lower()})")
+
+@st.fragment(run_every=GEOCODE_POLL_INTERVAL)
+def _geocode_poll():
+    """
+    Vänta på pågående geokodning utan att köra om hela sidan
+    
+    Bara fragmentet körs om medan uppslaget pågår (även när det väntar in
+    Nominatims anropsgräns); sidan körs om en gång när resultatet finns.
+    """
+    job = st.session_state.get("_pending_geocode")
+    if job is None or job["future"].done():
+        st.rerun()
+    st.caption("Söker adress...")
+
+@st.fragment
+def _summary_panel():
+    """
+    Sammanfattning och GPX-export
+    
+    Körs som fragment så att t.ex. ändring av ruttnamnet bara kör om den här
+    kolumnen och inte ritar om kartan.
+    """
+    st.subheader("Sammanfattning")
+    
+    if st.session_state.route_info:
+        route = st.session_state.route_info
+        
+        # Visa statistik
+        st.metric("Distans", f"{route.distance/1000:.2f} km")
+        st.metric("Höjdökning", f"{route.elevation_gain:.0f} m")
+        
+        # Uppskattad tid från rutten, beräknad med valt tempo eller providerns tid
+        hours, rest = divmod(route.estimated_seconds, 3600)
+        mins = rest // 60
+        time_str = f"{hours}:{mins:02d}" if hours > 0 else f"{mins} min"
+        st.metric("Uppskattad tid", time_str)
+        
+        st.divider()
+        
+        # GPX-export
+        st.subheader("Export")
+        
+        gpx_name = st.text_input(
+            "Ruttnamn",
+            value=st.session_state.gpx_default_name,
+            key="gpx_name"
+        )
+        
+        st.download_button(
+            label="Ladda ner GPX",
+            data=_gpx_bytes(_route_key(route), gpx_name, route),
+            file_name=f"{gpx_name.replace(' ', '_')}.gpx",
+            mime="application/gpx+xml",
+            use_container_width=True
+        )
+    else:
+        st.info("Generera en rutt för att se sammanfattning")
 
 def main():
     """Huvudfunktion för Streamlit-appen"""
@@ -59,8 +238,8 @@ def main():
         # Lägesval
         mode = st.radio(
             "Ruttläge",
-            ["loop", "point-to-point"],
-            format_func=lambda x: "Loop (start = mål)" if x == "loop" else "Point-to-point",
+            list(_MODE_LABELS),
+            format_func=_MODE_LABELS.get,
             key="mode"
         )
         
@@ -75,19 +254,34 @@ def main():
         )
         
         # Underlagstyp
-        surface_preference = st.selectbox(
-            "Underlag",
-            ["any", "paved", "unpaved", "trail"],
-            format_func=lambda x: {
-                "any": "Alla underlag",
-                "paved": "Asfalt/vägar",
-                "unpaved": "Grus/naturstigar", 
-                "trail": "Skogsstigar"
-            }.get(x, x),
-            key="surface_preference",
-            help="Välj vilket underlag du föredrar för din löprunda"
+        if USE_SURFACE_PREFERENCE:
+            surface_preference = st.selectbox(
+                "Underlag",
+                list(_SURFACE_LABELS),
+                format_func=_SURFACE_LABELS.get,
+                key="surface_preference",
+                help="Välj vilket underlag du föredrar för din löprunda"
+            )
+        
+        # Routing-provider
+        provider = st.selectbox(
+            "Routing-tjänst",
+            list(_PROVIDER_LABELS),
+            format_func=_PROVIDER_LABELS.get,
+            key="provider"
         )
         
+        # Tolerans, fast värde om FIXED_TOLERANCE är satt
+        if FIXED_TOLERANCE is None:
+            st.slider(
+                "Tolerans (%)",
+                min_value=1.0,
+                max_value=20.0,
+                step=1.0,
+                key="tolerance",
+                help="Hur mycket rutten får avvika från önskad distans"
+            )
+        
         st.divider()
         
         # Startpunkt
@@ -98,18 +292,8 @@ def main():
             key="start_address"
         )
         
-        # Auto-geokoda när adressen ändras
-        if start_address and start_address != st.session_state.last_start_address:
-            with st.spinner("Söker adress..."):
-                coords = geocode_address(start_address)
-                if coords:
-                    st.session_state.start_coords = coords
-                    st.session_state.last_start_address = start_address
-                    st.success(f"Startpunkt hittad")
-                else:
-                    st.error("Kunde inte hitta adressen")
-        
         # Slutpunkt för point-to-point
+        end_address = ""
         if mode == "point-to-point":
             st.divider()
             st.subheader("Slutpunkt")
@@ -118,17 +302,40 @@ def main():
                 placeholder="T.ex. Stureplan, Stockholm",
                 key="end_address"
             )
-            
-            # Auto-geokoda när adressen ändras
-            if end_address and end_address != st.session_state.last_end_address:
-                with st.spinner("Söker adress..."):
-                    coords = geocode_address(end_address)
-                    if coords:
-                        st.session_state.end_coords = coords
-                        st.session_state.last_end_address = end_address
-                        st.success(f"Slutpunkt hittad")
-                    else:
-                        st.error("Kunde inte hitta adressen")
+        
+        # Utan AUTO_GEOCODE söks adresserna först vid knapptryck
+        search_button = False
+        if not AUTO_GEOCODE:
+            search_button = st.button("Sök adress", use_container_width=True)
+        
+        # Geokoda adresser som ändrats, i bakgrunden så att sidan ritas direkt
+        job = st.session_state.get("_pending_geocode")
+        pending = [
+            (role, address)
+            for role, address in (("start", start_address), ("end", end_address))
+            if len(address.strip()) >= MIN_GEOCODE_QUERY_LENGTH
+            and address != st.session_state[f"last_{role}_address"]
+        ] if AUTO_GEOCODE or search_button else []
+        
+        if pending and job is None:
+            for role, address in pending:
+                st.session_state[f"last_{role}_address"] = address
+            job = st.session_state["_pending_geocode"] = {
+                "pending": pending,
+                "future": _geocode_executor().submit(
+                    geocode_addresses, [address for _, address in pending], MAPBOX_ENABLED
+                )
+            }
+        
+        # Snabba svar (t.ex. cache-träffar) tillämpas i samma körning så att
+        # ingen extra omkörning behövs
+        if job:
+            wait([job["future"]], timeout=GEOCODE_INLINE_WAIT)
+        if job and job["future"].done():
+            _apply_geocode(job)
+        
+        if st.session_state.get("_pending_geocode"):
+            _geocode_poll()
         
         st.divider()
         
@@ -142,7 +349,18 @@ def main():
                                          help="Generera en annan rutt med samma inställningar")
         
         if generate_button or regenerate_button:
-            if not st.session_state.start_coords:
+            # Adressen som just skrevs in geokodas redan i bakgrunden; vänta in
+            # den istället för att kräva ett nytt klick
+            job = st.session_state.get("_pending_geocode")
+            if job:
+                with st.spinner("Söker adress..."):
+                    wait([job["future"]], timeout=GEOCODE_CLICK_WAIT)
+                if job["future"].done():
+                    _apply_geocode(job)
+            
+            if st.session_state.get("_pending_geocode"):
+                st.warning("Adressen söks fortfarande, försök igen om en stund.")
+            elif not st.session_state.start_coords:
                 st.error("Välj en startpunkt först!")
             elif mode == "point-to-point" and not st.session_state.end_coords:
                 st.error("Välj en slutpunkt först!")
@@ -152,38 +370,46 @@ def main():
                     st.session_state.route_seed += 10  # Öka med 10 för att garantera olika resultat
                 
                 with st.spinner("Beräknar rutt..."):
-                    # Skapa cache-nyckel med seed och provider
-                    coords = [[st.session_state.start_coords[1], st.session_state.start_coords[0]]]
-                    if mode == "point-to-point":
-                        coords.append([st.session_state.end_coords[1], st.session_state.end_coords[0]])
-                    
-                    # Fast tolerans på 5%
-                    tolerance = 5.0
+                    tolerance = FIXED_TOLERANCE if FIXED_TOLERANCE is not None else st.session_state.tolerance
                     
                     # Hämta underlagsval
-                    surface_pref = st.session_state.get("surface_preference", "any")
-                    
-                    cache_key = create_cache_key(
-                        coords, distance, mode, tolerance, 
-                        st.session_state.route_seed, "auto"
+                    surface_pref = (
+                        st.session_state.get("surface_preference", "any")
+                        if USE_SURFACE_PREFERENCE else "any"
                     )
                     
-                    route_info = get_best_route(
+                    args = (
                         st.session_state.start_coords,
-                        st.session_state.end_coords if mode == "point-to-point" else None,
+                        st.session_state.end_coords,
                         distance,
                         tolerance,
                         mode,
                         st.session_state.route_seed,
-                        "auto",
-                        cache_key,
-                        surface_preference=surface_pref
+                        surface_pref,
+                        st.session_state.pace
                     )
+                    route_info = _fetch_route(provider, *args)
                     
                     if route_info:
                         st.session_state.route_info = route_info
                     else:
                         st.error("Kunde inte generera rutt. Försök justera inställningarna.")
+        
+        # Widgets får inte skapas i cachade funktioner, så debugvalet ligger här
+        st.checkbox("Visa debug", value=False, key="debug_mode")
+        
+        # Providerns försök följer med rutten och visas här, utanför den cachade hämtningen
+        debug_route = st.session_state.route_info
+        if st.session_state.debug_mode and debug_route and debug_route.attempts:
+            with st.expander(
+                f"{debug_route.provider} testade {len(debug_route.attempts)} varianter", expanded=False
+            ):
+                for info in debug_route.attempts:
+                    st.text(info)
+                if debug_route.within_tolerance:
+                    st.success("Hittade rutt inom tolerans")
+                else:
+                    st.warning("Ingen rutt inom tolerans hittades")
     
     # Huvudinnehåll
     col1, col2 = st.columns([2, 1])
@@ -192,63 +418,46 @@ def main():
         st.subheader("Karta")
         
         # Skapa karta
-        center = list(st.session_state.start_coords) if st.session_state.start_coords else DEFAULT_CENTER
+        center = st.session_state.start_coords or DEFAULT_CENTER
         
-        m = create_map(
-            center,
-            st.session_state.route_info,
-            st.session_state.start_coords,
-            st.session_state.end_coords if st.session_state.mode == "point-to-point" else None
-        )
+        route_info = st.session_state.route_info
+        end_marker = st.session_state.end_coords if st.session_state.mode == "point-to-point" else None
+        
+        # Återanvänd sessionens karta om inget som syns på den har ändrats
+        map_sig = (center, id(route_info), _route_key(route_info), st.session_state.start_coords, end_marker)
+        if st.session_state.get("_map_sig") == map_sig:
+            m = st.session_state["_map_obj"]
+        else:
+            m = _cached_map(
+                center,
+                route_info,
+                st.session_state.start_coords,
+                end_marker
+            )
+            st.session_state["_map_sig"] = map_sig
+            st.session_state["_map_obj"] = m
         
-        # Visa karta
+        from streamlit_folium import st_folium
+        
+        # Visa karta. st_folium skickar tillbaka sina returned_objects över
+        # websocketen vid varje omkörning; kartan hanterar inga klick här
+        # Nyckeln följer ruttens identitet: komponenten monteras om (och
+        # zoomar till rutten) bara när rutten byts
+        # Kartan som redan renderats i sessionen renderas inte om från
+        # grunden (render=False) när t.ex. bara debugvalet ändrats
+        st.session_state.setdefault("_map_rendered_sig", None)
         st_folium(
             m,
-            key="map",
+            key=f"map-{_route_key(route_info) or 'empty'}",
             width=None,
-            height=500
+            height=500,
+            returned_objects=[],
+            render=st.session_state["_map_rendered_sig"] != map_sig
         )
+        st.session_state["_map_rendered_sig"] = map_sig
     
     with col2:
-        st.subheader("Sammanfattning")
-        
-        if st.session_state.route_info:
-            route = st.session_state.route_info
-            
-            # Visa statistik
-            st.metric("Distans", f"{route.distance/1000:.2f} km")
-            st.metric("Höjdökning", f"{route.elevation_gain:.0f} m")
-            
-            # Beräkna tid baserat på standardtempo
-            pace_min = 5.5  # Standard 5:30 min/km
-            time_minutes = (route.distance / 1000) * pace_min
-            hours = int(time_minutes // 60)
-            mins = int(time_minutes % 60)
-            time_str = f"{hours}:{mins:02d}" if hours > 0 else f"{mins} min"
-            st.metric("Uppskattad tid", time_str)
-            
-            st.divider()
-            
-            # GPX-export
-            st.subheader("Export")
-            
-            gpx_name = st.text_input(
-                "Ruttnamn",
-                value=f"Löprunda {datetime.now().strftime('%Y-%m-%d')}",
-                key="gpx_name"
-            )
-            
-            if st.button("Ladda ner GPX", use_container_width=True):
-                gpx_content = create_gpx(route, gpx_name)
-                st.download_button(
-                    label="Spara GPX-fil",
-                    data=gpx_content,
-                    file_name=f"{gpx_name.replace(' ', '_')}.gpx",
-                    mime="application/gpx+xml",
-                    use_container_width=True
-                )
-        else:
-            st.info("Generera en rutt för att se sammanfattning")
+        _summary_panel()
     
     # Footer
     st.divider()
@@ -3,11 +3,24 @@ Kartfunktioner för visualisering
 """
 
 import folium
-from typing import List, Optional, Tuple
+import numpy as np
+from typing import Optional, Tuple
+from config import MAP_SIMPLIFY_TOLERANCE, MAP_SIMPLIFY_MIN_POINTS
 from models import RouteInfo
+from utils import simplify_points
+
+# Markörernas utseende, (popup, ikonargument). Själva folium.Icon kan inte
+# delas mellan kartor eftersom ett element bara kan ha en förälder.
+_START_MARKER = ("Start", {"color": "green", "icon": "play"})
+_END_MARKER = ("Mål", {"color": "red", "icon": "stop"})
+
+def _add_marker(m: folium.Map, location: Tuple[float, float], style: Tuple[str, dict]):
+    """Lägg till en start- eller målmarkör på kartan"""
+    popup, icon = style
+    folium.Marker(location, popup=popup, icon=folium.Icon(**icon)).add_to(m)
 
 def create_map(
-    center: List[float], 
+    center: Tuple[float, float], 
     route_info: Optional[RouteInfo] = None,
     start_marker: Optional[Tuple[float, float]] = None,
     end_marker: Optional[Tuple[float, float]] = None
@@ -15,8 +28,11 @@ def create_map(
     """
     Skapa Folium-karta med rutt och markörer
     
+    Långa rutter förenklas (Douglas-Peucker) innan de ritas, vilket minskar
+    det som skickas till webbläsaren. route_info lämnas orörd för GPX-export.
+    
     Args:
-        center: Kartans centrum [lat, lon]
+        center: Kartans centrum (lat, lon)
         route_info: Ruttinformation
         start_marker: Startmarkör (lat, lon)
         end_marker: Slutmarkör (lat, lon)
@@ -30,25 +46,20 @@ def create_map(
         control_scale=True
     )
     
-    # Lägg till startmarkör
+    # Lägg till start- och slutmarkör
     if start_marker:
-        folium.Marker(
-            start_marker,
-            popup="Start",
-            icon=folium.Icon(color="green", icon="play")
-        ).add_to(m)
-    
-    # Lägg till slutmarkör
+        _add_marker(m, start_marker, _START_MARKER)
     if end_marker:
-        folium.Marker(
-            end_marker,
-            popup="Mål",
-            icon=folium.Icon(color="red", icon="stop")
-        ).add_to(m)
+        _add_marker(m, end_marker, _END_MARKER)
     
     # Rita rutt
-    if route_info and route_info.points:
-        route_coords = [[p.lat, p.lon] for p in route_info.points]
+    if route_info and len(route_info.lats):
+        lats, lons = route_info.lats, route_info.lons
+        if len(lats) > MAP_SIMPLIFY_MIN_POINTS:
+            keep = simplify_points(lats, lons, MAP_SIMPLIFY_TOLERANCE)
+            route_coords = np.column_stack([lats[keep], lons[keep]]).tolist()
+        else:
+            route_coords = np.column_stack([lats, lons]).tolist()
         
         folium.PolyLine(
             route_coords,
@@ -60,8 +71,9 @@ def create_map(
         
         # Anpassa zoom för att visa hela rutten
         if len(route_coords) > 1:
-            bounds = [[min(p[0] for p in route_coords), min(p[1] for p in route_coords)],
-                     [max(p[0] for p in route_coords), max(p[1] for p in route_coords)]]
-            m.fit_bounds(bounds)
+            m.fit_bounds([
+                [float(lats.min()), float(lons.min())],
+                [float(lats.max()), float(lons.max())]
+            ])
     
     return m
\ No newline at end of file
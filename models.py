@@ -2,23 +2,48 @@
 Datamodeller för löparruttplaneraren
 """
 
-from dataclasses import dataclass
-from datetime import timedelta
-from typing import List, Optional
+import numpy as np
+from dataclasses import dataclass, field
+from typing import List, NamedTuple, Optional
 
-@dataclass
-class RoutePoint:
-    """Representerar en punkt på rutten"""
+# Version av RouteInfo-schemat för disk-cachen. Pickle laddar även poster med
+# saknade eller borttagna fält utan fel, så öka värdet när fälten ändras.
+ROUTE_INFO_VERSION = 1
+
+class RoutePoint(NamedTuple):
+    """
+    Representerar en punkt på rutten
+    
+    NamedTuple istället för dataclass: ingen __dict__ per punkt, vilket
+    spelar roll när points bygger tusentals på en gång.
+    """
     lat: float
     lon: float
     elevation: Optional[float] = None
 
 @dataclass
 class RouteInfo:
-    """Information om en rutt"""
-    points: List[RoutePoint]
+    """
+    Information om en rutt
+    
+    Punkterna lagras kolumnvis som float64-arrayer (lats, lons, elevations)
+    istället för ett RoutePoint-objekt per punkt. Saknad höjd är NaN.
+    """
+    lats: np.ndarray
+    lons: np.ndarray
+    elevations: np.ndarray  # meter, NaN där höjd saknas
     distance: float  # meter
     elevation_gain: float  # meter
-    estimated_time: timedelta
-    geometry: List[List[float]]
-    provider: str = "ORS"  # Vilket API som användes
\ No newline at end of file
+    estimated_seconds: int  # sekunder
+    provider: str = "ORS"  # Vilket API som användes
+    # Debuginfo från providerns sökning, visas i huvudtråden vid debugläge
+    attempts: List[str] = field(default_factory=list)
+    within_tolerance: Optional[bool] = None
+    
+    @property
+    def points(self) -> List[RoutePoint]:
+        """Punkterna som RoutePoint-lista, skapas vid behov"""
+        return [
+            RoutePoint(lat, lon, None if ele != ele else ele)
+            for lat, lon, ele in zip(self.lats.tolist(), self.lons.tolist(), self.elevations.tolist())
+        ]
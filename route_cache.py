@@ -0,0 +1,61 @@
+"""
+Persistent SQLite-cache för ruttresultat som överlever omstarter
+"""
+
+import pickle
+import sqlite3
+import time
+from typing import Optional
+from sqlite_cache import SharedConnection
+from config import ROUTE_CACHE_PATH, CACHE_TTL
+from models import RouteInfo, ROUTE_INFO_VERSION
+
+# Providers kan köras i flera trådar, så all åtkomst går via _db.lock
+_db = SharedConnection(
+    ROUTE_CACHE_PATH,
+    "CREATE TABLE IF NOT EXISTS route (key TEXT PRIMARY KEY, data BLOB, ts REAL)"
+)
+
+def _versioned(key: str) -> str:
+    """Nyckel med schemaversion, så att poster från en annan RouteInfo blir missar"""
+    return f"v{ROUTE_INFO_VERSION}:{key}"
+
+def get_route(key: str) -> Optional[RouteInfo]:
+    """
+    Hämta cachad rutt
+    
+    Args:
+        key: Nyckel från create_cache_key
+    
+    Returns:
+        RouteInfo eller None om nyckeln saknas, är för gammal eller inte kan läsas
+    """
+    try:
+        with _db.lock:
+            row = _db.connect().execute(
+                "SELECT data FROM route WHERE key = ? AND ts > ?",
+                (_versioned(key), time.time() - CACHE_TTL)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    if not row:
+        return None
+    try:
+        return pickle.loads(row[0])
+    except Exception:
+        # Skadad post, eller en klass som inte längre kan importeras
+        return None
+
+def set_route(key: str, route_info: RouteInfo):
+    """Spara en rutt under dess cache-nyckel"""
+    data = pickle.dumps(route_info, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        with _db.lock:
+            conn = _db.connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO route (key, data, ts) VALUES (?, ?, ?)",
+                    (_versioned(key), data, time.time())
+                )
+    except sqlite3.Error:
+        pass
@@ -3,23 +3,62 @@ Huvudsaklig routing-modul som koordinerar olika providers
 """
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import hashlib
-from typing import Tuple, Optional, List
-from config import CACHE_TTL
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import struct
+from functools import lru_cache
+import numpy as np
+from typing import Tuple, Optional, List, Union
+from config import CACHE_TTL, DEFAULT_PACE
 from models import RouteInfo
+from route_cache import get_route, set_route
 from routing_providers import OpenRouteServiceProvider, GraphHopperProvider
+from utils import parse_pace_seconds
 
 def create_cache_key(
-    coordinates: List[List[float]], 
+    coordinates: Union[np.ndarray, List[List[float]]],
     distance: float,
     mode: str, 
     tolerance: float, 
     seed: int = 0,
-    provider: str = "auto"
+    provider: str = "auto",
+    surface_preference: str = "any",
+    pace_seconds: int = 0
+) -> str:
+    """
+    Skapa cache-nyckel för routing
+    
+    Koordinaterna plattas till en tupel och själva hashningen memoiseras,
+    så samma indata vid upprepade omkörningar ger nyckeln direkt.
+    """
+    if isinstance(coordinates, np.ndarray):
+        flat = tuple(coordinates.ravel().tolist())
+    else:
+        flat = tuple(value for coord in coordinates for value in coord)
+    return _cache_key_tuple(
+        flat, float(distance), mode, float(tolerance), int(seed), provider, surface_preference,
+        int(pace_seconds)
+    )
+
+@lru_cache(maxsize=128)
+def _cache_key_tuple(
+    coords: Tuple[float, ...],
+    distance: float,
+    mode: str,
+    tolerance: float,
+    seed: int,
+    provider: str,
+    surface_preference: str,
+    pace_seconds: int
 ) -> str:
-    """Skapa cache-nyckel för routing"""
-    key_str = f"{coordinates}_{distance}_{mode}_{tolerance}_{seed}_{provider}"
-    return hashlib.md5(key_str.encode()).hexdigest()
+    """Hasha nyckelns delar med blake2b, koordinaterna som packade float64-bytes"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(struct.pack(f"<I{len(coords)}d", len(coords), *coords))
+    h.update(struct.pack("<ddqq", distance, tolerance, seed, pace_seconds))
+    h.update(f"{mode}|{provider}|{surface_preference}".encode())
+    return h.hexdigest()
 
 def get_best_route(
     start: Tuple[float, float],
@@ -29,12 +68,14 @@ def get_best_route(
     mode: str = "loop",
     seed: int = 0,
     provider: str = "auto",
-    _cache_key: str = "",
-    surface_preference: str = "any"
+    surface_preference: str = "any",
+    pace: str = DEFAULT_PACE
 ) -> Optional[RouteInfo]:
     """
     Hämta bästa möjliga rutt från tillgängliga providers
-    OBS: Ingen caching här för att "Ny variant" ska fungera
+    
+    Resultatet sparas på disk under create_cache_key så att det överlever
+    omstarter. Seed ingår i nyckeln, så "Ny variant" ger fortfarande en ny rutt.
     
     Args:
         start: (lat, lon) för startpunkt
@@ -44,14 +85,26 @@ def get_best_route(
         mode: "loop" eller "point-to-point"
         seed: Seed för variation
         provider: "auto", "ors", "graphhopper", eller "both"
-        _cache_key: Cache-nyckel (används inte längre)
         surface_preference: "any", "paved", "unpaved", "trail"
+        pace: Tempo som "mm:ss" per km, för uppskattad tid
     
     Returns:
         RouteInfo eller None vid fel
     """
     
-    routes = []
+    # Tempot tolkas en gång här istället för i varje svarsparser
+    pace_seconds = parse_pace_seconds(pace)
+    
+    coordinates = [[start[1], start[0]]]
+    if end:
+        coordinates.append([end[1], end[0]])
+    cache_key = create_cache_key(
+        coordinates, distance_km, mode, tolerance_percent, seed, provider, surface_preference,
+        pace_seconds
+    )
+    cached = get_route(cache_key)
+    if cached:
+        return cached
     
     # Välj providers baserat på inställning
     if provider == "auto":
@@ -64,37 +117,46 @@ def get_best_route(
             st.error("Ingen API-nyckel konfigurerad!")
             return None
     
-    # Hämta rutter från valda providers
-    if provider in ["ors", "both"]:
-        if "ORS_API_KEY" in st.secrets:
-            ors_provider = OpenRouteServiceProvider()
-            ors_route = ors_provider.get_route(
-                start, end, distance_km, tolerance_percent, mode, seed, surface_preference
-            )
-            if ors_route:
-                routes.append(ors_route)
+    # Valda providers med konfigurerad nyckel
+    providers = []
+    if provider in ["ors", "both"] and "ORS_API_KEY" in st.secrets:
+        providers.append(OpenRouteServiceProvider())
+    if provider in ["graphhopper", "both"] and "GRAPHHOPPER_API_KEY" in st.secrets:
+        providers.append(GraphHopperProvider())
     
-    if provider in ["graphhopper", "both"]:
-        if "GRAPHHOPPER_API_KEY" in st.secrets:
-            gh_provider = GraphHopperProvider()
-            gh_route = gh_provider.get_route(
-                start, end, distance_km, tolerance_percent, mode, seed, surface_preference
-            )
-            if gh_route:
-                routes.append(gh_route)
+    def fetch(route_provider):
+        return route_provider.get_route(
+            start, end, distance_km, tolerance_percent, mode, seed, surface_preference,
+            pace_seconds
+        )
     
-    # Om vi har flera rutter, välj den bästa (tyst)
-    if len(routes) > 1:
-        target_distance = distance_km * 1000
-        tolerance_m = target_distance * (tolerance_percent / 100)
+    # Hämta rutter, parallellt när båda providers används eftersom anropen är
+    # oberoende. Trådarna behöver sessionens kontext för session state och secrets.
+    if len(providers) > 1:
+        ctx = get_script_run_ctx()
         
-        # Sortera rutter: först de inom tolerans, sedan närmast måldistans
-        def route_score(route):
-            deviation = abs(route.distance - target_distance)
-            within_tolerance = deviation <= tolerance_m
-            # Lägre poäng är bättre
-            return (0 if within_tolerance else 1, deviation)
+        def fetch_in_thread(route_provider):
+            add_script_run_ctx(threading.current_thread(), ctx)
+            return fetch(route_provider)
         
-        routes.sort(key=route_score)
+        with ThreadPoolExecutor(max_workers=len(providers)) as executor:
+            futures = [executor.submit(fetch_in_thread, p) for p in providers]
+            routes = [f.result() for f in as_completed(futures)]
+    else:
+        routes = [fetch(p) for p in providers]
+    routes = [route for route in routes if route]
+    if not routes:
+        return None
+    
+    # Välj den bästa rutten (tyst): först de inom tolerans, sedan närmast måldistans
+    target_distance = distance_km * 1000
+    tolerance_m = target_distance * (tolerance_percent / 100)
+    
+    def route_score(route):
+        deviation = abs(route.distance - target_distance)
+        # Lägre poäng är bättre; False (inom tolerans) sorteras före True
+        return (deviation > tolerance_m, deviation)
     
-    return routes[0] if routes else None
\ No newline at end of file
+    best = min(routes, key=route_score)
+    set_route(cache_key, best)
+    return best
@@ -4,19 +4,70 @@ Routing-providers: ORS och GraphHopper
 
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Tuple, Optional, List
-from datetime import timedelta
 import math
 
+try:
+    import orjson as _json  # Snabbare avkodning av stora GeoJSON-svar om tillgängligt
+except ImportError:
+    import json as _json
+
 from config import (
     ORS_BASE_URL, 
     GRAPHHOPPER_BASE_URL,
     MAX_ROUTE_ATTEMPTS,
-    PERFECT_TOLERANCE_PERCENT
+    PERFECT_TOLERANCE_PERCENT,
+    ROUTE_ATTEMPT_WORKERS
 )
-from models import RouteInfo, RoutePoint
-from utils import calculate_elevation_gain, calculate_distance_from_points, parse_pace
+from models import RouteInfo
+from utils import calculate_elevation_gain, calculate_distance_from_points, coordinates_to_arrays
+
+class _TimeoutSession(requests.Session):
+    """Session med standard-timeout för alla anrop"""
+    
+    def __init__(self, timeout: float):
+        super().__init__()
+        self._timeout = timeout
+    
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self._timeout)
+        return super().request(*args, **kwargs)
+
+def _make_session(method: str, headers: dict) -> requests.Session:
+    """
+    Skapa en delad session mot en routing-tjänst
+    
+    TLS-anslutningen återanvänds mellan försöken. Rate limit (429) och
+    tillfälliga serverfel försöks om med backoff.
+    """
+    session = _TimeoutSession(timeout=30)
+    session.headers.update(headers)
+    session.mount("https://", HTTPAdapter(
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.3,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=(method,)
+        ),
+        pool_connections=4,
+        pool_maxsize=16
+    ))
+    return session
+
+_ORS = _make_session("POST", {"Content-Type": "application/json"})
+_GH = _make_session("GET", {"Accept": "application/json"})
+
+def _ors_distance(data: Optional[dict]) -> Optional[float]:
+    """Distans i meter för första rutten i ett ORS-svar"""
+    try:
+        return data["features"][0]["properties"]["summary"]["distance"]
+    except (TypeError, KeyError, IndexError):
+        return None
 
 class RoutingProvider:
     """Basklass för routing-providers"""
@@ -27,7 +78,10 @@ class RoutingProvider:
         end: Optional[Tuple[float, float]],
         distance_km: float,
         tolerance_percent: float,
-        mode: str = "loop"
+        mode: str = "loop",
+        seed: int = 0,
+        surface_preference: str = "any",
+        pace_seconds: int = 330
     ) -> Optional[RouteInfo]:
         raise NotImplementedError
 
@@ -45,7 +99,8 @@ class OpenRouteServiceProvider(RoutingProvider):
         tolerance_percent: float,
         mode: str = "loop",
         seed: int = 0,
-        surface_preference: str = "any"
+        surface_preference: str = "any",
+        pace_seconds: int = 330
     ) -> Optional[RouteInfo]:
         """Hämta rutt från OpenRouteService med underlagsval"""
         
@@ -54,19 +109,22 @@ class OpenRouteServiceProvider(RoutingProvider):
             
         url = f"{ORS_BASE_URL}/v2/directions/foot-walking/geojson"
         headers = {
-            "Authorization": st.secrets["ORS_API_KEY"],
-            "Content-Type": "application/json"
+            "Authorization": st.secrets["ORS_API_KEY"]
         }
         
         distance_m = distance_km * 1000
         tolerance_m = distance_m * (tolerance_percent / 100)
         
         if mode == "loop":
-            best_route = self._find_best_loop_route(
+            best_route, attempts_info, found_within_tolerance = self._find_best_loop_route(
                 start, distance_m, tolerance_m, headers, url, seed, surface_preference
             )
             if best_route:
-                return self._parse_ors_response(best_route)
+                route = self._parse_ors_response(best_route, pace_seconds)
+                if route:
+                    route.attempts = attempts_info
+                    route.within_tolerance = found_within_tolerance
+                return route
         else:
             # Point-to-point implementation
             if not end:
@@ -75,7 +133,7 @@ class OpenRouteServiceProvider(RoutingProvider):
                 start, end, distance_m, tolerance_m, headers, url, surface_preference
             )
             if route_data:
-                return self._parse_ors_response(route_data)
+                return self._parse_ors_response(route_data, pace_seconds)
         
         return None
     
@@ -88,8 +146,8 @@ class OpenRouteServiceProvider(RoutingProvider):
         url: str,
         seed: int,
         surface_preference: str = "any"
-    ) -> Optional[dict]:
-        """Hitta bästa loop-rutten genom att testa flera varianter"""
+    ) -> Tuple[Optional[dict], List[str], bool]:
+        """Hitta bästa loop-rutten genom att testa flera varianter, med försöken för debug"""
         
         best_route = None
         best_deviation = float('inf')
@@ -117,62 +175,61 @@ class OpenRouteServiceProvider(RoutingProvider):
             options["prefer_features"] = ["tracks"]
             options["avoid_features"] = ["highways"]
         
+        # Alla varianter byggs i förväg; varje försök får en egen kopia av
+        # round_trip så att seeds inte skriver över varandra
+        bodies = []
         for attempt in range(MAX_ROUTE_ATTEMPTS):
             route_seed = seed + attempt if seed > 0 else random.randint(1, 100000)
-            
-            # Uppdatera seed för denna iteration
-            current_options = options.copy()
-            current_options["round_trip"]["seed"] = route_seed
-            
-            body = {
+            current_options = dict(options, round_trip=dict(options["round_trip"], seed=route_seed))
+            bodies.append({
                 "coordinates": [[start[1], start[0]]],
                 "elevation": True,
+                "instructions": False,
                 "options": current_options
+            })
+        
+        # Försöken skickas parallellt och behandlas i den ordning de blir klara.
+        # Återstående försök avbryts när en tillräckligt bra rutt hittats: köade
+        # försök ställs in och pågående slutar läsa sina svar via abort.
+        abort = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=ROUTE_ATTEMPT_WORKERS)
+        try:
+            futures = {
+                executor.submit(self._post_route, url, body, headers, abort): attempt
+                for attempt, body in enumerate(bodies)
             }
-            
-            try:
-                response = requests.post(url, json=body, headers=headers, timeout=30)
-                if response.status_code == 200:
-                    data = response.json()
-                    if "features" in data and data["features"]:
-                        route_distance = data["features"][0]["properties"]["summary"]["distance"]
-                        deviation = abs(route_distance - distance_m)
-                        deviation_percent = ((route_distance - distance_m) / distance_m) * 100
-                        
-                        within_tolerance = deviation <= tolerance_m
-                        status = "✓" if within_tolerance else ""
-                        attempts_info.append(
-                            f"ORS variant {attempt + 1}: {route_distance/1000:.2f} km ({deviation_percent:+.1f}%) {status}"
-                        )
-                        
-                        if within_tolerance:
-                            if not found_within_tolerance or deviation < best_deviation:
-                                found_within_tolerance = True
-                                best_deviation = deviation
-                                best_route = data
-                            if abs(deviation_percent) <= PERFECT_TOLERANCE_PERCENT:
-                                break
-                        elif not found_within_tolerance and deviation < best_deviation:
+            for completed, future in enumerate(as_completed(futures), start=1):
+                data = future.result()
+                route_distance = _ors_distance(data)
+                if route_distance is not None:
+                    deviation = abs(route_distance - distance_m)
+                    deviation_percent = ((route_distance - distance_m) / distance_m) * 100
+                    
+                    within_tolerance = deviation <= tolerance_m
+                    status = "✓" if within_tolerance else ""
+                    attempts_info.append(
+                        f"ORS variant {futures[future] + 1}: {route_distance/1000:.2f} km ({deviation_percent:+.1f}%) {status}"
+                    )
+                    
+                    if within_tolerance:
+                        if not found_within_tolerance or deviation < best_deviation:
+                            found_within_tolerance = True
                             best_deviation = deviation
                             best_route = data
+                        if abs(deviation_percent) <= PERFECT_TOLERANCE_PERCENT:
+                            break
+                    elif not found_within_tolerance and deviation < best_deviation:
+                        best_deviation = deviation
+                        best_route = data
                 
-                if found_within_tolerance and attempt >= 2:
+                if found_within_tolerance and completed >= 3:
                     break
-                    
-            except Exception:
-                continue
-        
-        # Visa resultat endast om debug mode
-        if attempts_info and st.checkbox("Visa debug", value=False, key="debug_ors"):
-            with st.expander(f"ORS testade {len(attempts_info)} varianter", expanded=False):
-                for info in attempts_info:
-                    st.text(info)
-                if found_within_tolerance:
-                    st.success(f"Hittade rutt inom tolerans ({tolerance_percent}%)")
-                else:
-                    st.warning("Ingen rutt inom tolerans hittades")
-        
-        return best_route
+        finally:
+            abort.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        # Försöken returneras och visas av anroparen, inte här i sökningen
+        return best_route, attempts_info, found_within_tolerance
     
     def _get_point_to_point_route(
         self,
@@ -206,16 +263,30 @@ class OpenRouteServiceProvider(RoutingProvider):
         if options:
             body["options"] = options
         
+        return self._post_route(url, body, headers)
+    
+    def _post_route(
+        self,
+        url: str,
+        body: dict,
+        headers: dict,
+        abort: Optional[threading.Event] = None
+    ) -> Optional[dict]:
+        """Skicka ett ruttanrop till ORS, None vid fel eller om sökningen avbrutits"""
+        if abort is not None and abort.is_set():
+            return None
         try:
-            response = requests.post(url, json=body, headers=headers, timeout=30)
-            if response.status_code == 200:
-                return response.json()
+            # stream=True: kroppen läses först efter kontrollen av abort, annars
+            # stängs svaret oläst
+            with _ORS.post(url, json=body, headers=headers, stream=True) as response:
+                if response.status_code == 200 and not (abort is not None and abort.is_set()):
+                    return _json.loads(response.content)
         except Exception:
             pass
         
         return None
     
-    def _parse_ors_response(self, data: dict) -> Optional[RouteInfo]:
+    def _parse_ors_response(self, data: dict, pace_seconds: int) -> Optional[RouteInfo]:
         """Parsa ORS-respons till RouteInfo"""
         
         if "features" not in data or not data["features"]:
@@ -226,33 +297,22 @@ class OpenRouteServiceProvider(RoutingProvider):
         properties = feature.get("properties", {})
         
         coordinates = geometry.get("coordinates", [])
-        points = []
-        
-        for coord in coordinates:
-            if len(coord) >= 2:
-                elevation = coord[2] if len(coord) > 2 else None
-                points.append(RoutePoint(
-                    lat=coord[1],
-                    lon=coord[0],
-                    elevation=elevation
-                ))
+        lats, lons, elevations = coordinates_to_arrays(coordinates)
         
         ascent = properties.get("ascent", 0)
-        elevation_gain = ascent if ascent > 0 else calculate_elevation_gain(points)
+        elevation_gain = ascent if ascent > 0 else calculate_elevation_gain(elevations)
         
         distance = properties.get("summary", {}).get("distance", 0)
-        if distance == 0 and points:
-            distance = calculate_distance_from_points(points)
-        
-        pace_min = parse_pace(st.session_state.get("pace", "5:30"))
-        time_minutes = (distance / 1000) * pace_min
+        if distance == 0 and len(lats):
+            distance = calculate_distance_from_points(lats, lons)
         
         return RouteInfo(
-            points=points,
+            lats=lats,
+            lons=lons,
+            elevations=elevations,
             distance=distance,
             elevation_gain=elevation_gain,
-            estimated_time=timedelta(minutes=time_minutes),
-            geometry=coordinates,
+            estimated_seconds=int(distance * pace_seconds / 1000),
             provider="ORS"
         )
 
@@ -270,7 +330,8 @@ class GraphHopperProvider(RoutingProvider):
         tolerance_percent: float,
         mode: str = "loop",
         seed: int = 0,
-        surface_preference: str = "any"
+        surface_preference: str = "any",
+        pace_seconds: int = 330
     ) -> Optional[RouteInfo]:
         """Hämta rutt från GraphHopper med underlagsval"""
         
@@ -281,11 +342,13 @@ class GraphHopperProvider(RoutingProvider):
         tolerance_m = distance_m * (tolerance_percent / 100)
         
         if mode == "loop":
-            return self._get_round_trip(start, distance_m, tolerance_m, seed, surface_preference)
+            return self._get_round_trip(
+                start, distance_m, tolerance_m, seed, surface_preference, pace_seconds
+            )
         else:
             if not end:
                 return None
-            return self._get_point_to_point(start, end, surface_preference)
+            return self._get_point_to_point(start, end, surface_preference, pace_seconds)
     
     def _get_round_trip(
         self,
@@ -293,7 +356,8 @@ class GraphHopperProvider(RoutingProvider):
         distance_m: float,
         tolerance_m: float,
         seed: int,
-        surface_preference: str = "any"
+        surface_preference: str = "any",
+        pace_seconds: int = 330
     ) -> Optional[RouteInfo]:
         """Hämta round trip från GraphHopper med underlagsval"""
         
@@ -304,9 +368,6 @@ class GraphHopperProvider(RoutingProvider):
         attempts_info = []
         found_within_tolerance = False
         
-        # Beräkna tolerance_percent från tolerance_m
-        tolerance_percent = (tolerance_m / distance_m) * 100
-        
         # GraphHopper har ofta bättre precision, så vi testar färre varianter
         max_attempts = 5
         
@@ -319,6 +380,7 @@ class GraphHopperProvider(RoutingProvider):
         }
         vehicle = profile_map.get(surface_preference, "foot")
         
+        param_sets = []
         for attempt in range(max_attempts):
             current_seed = seed + attempt if seed > 0 else random.randint(1, 100000)
             
@@ -335,6 +397,7 @@ class GraphHopperProvider(RoutingProvider):
                 "round_trip.seed": current_seed,
                 "elevation": "true",
                 "points_encoded": "false",
+                "instructions": "false",
                 "locale": "sv"
             }
             
@@ -359,57 +422,79 @@ class GraphHopperProvider(RoutingProvider):
                     ]
                 }
             
-            try:
-                response = requests.get(url, params=params, timeout=30)
-                if response.status_code == 200:
-                    data = response.json()
-                    if "paths" in data and data["paths"]:
-                        path = data["paths"][0]
-                        route_distance = path.get("distance", 0)
-                        deviation = abs(route_distance - distance_m)
-                        deviation_percent = ((route_distance - distance_m) / distance_m) * 100
-                        
-                        within_tolerance = deviation <= tolerance_m
-                        status = "✓" if within_tolerance else ""
-                        attempts_info.append(
-                            f"GraphHopper variant {attempt + 1}: {route_distance/1000:.2f} km ({deviation_percent:+.1f}%) {status}"
-                        )
-                        
-                        if within_tolerance:
-                            if not found_within_tolerance or deviation < best_deviation:
-                                found_within_tolerance = True
-                                best_deviation = deviation
-                                best_route = data
-                            if abs(deviation_percent) <= PERFECT_TOLERANCE_PERCENT:
-                                break
-                        elif not found_within_tolerance and deviation < best_deviation:
+            param_sets.append(params)
+        
+        # Samma mönster som för ORS: parallella försök, avbryt vid träff.
+        # Fel visas här i anropande tråd, inte i arbetstrådarna.
+        abort = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=ROUTE_ATTEMPT_WORKERS)
+        try:
+            futures = {
+                executor.submit(self._get_json, url, params, abort): attempt
+                for attempt, params in enumerate(param_sets)
+            }
+            for future in as_completed(futures):
+                try:
+                    data = future.result()
+                except Exception as e:
+                    st.warning(f"GraphHopper fel: {str(e)}")
+                    continue
+                if data and "paths" in data and data["paths"]:
+                    path = data["paths"][0]
+                    route_distance = path.get("distance", 0)
+                    deviation = abs(route_distance - distance_m)
+                    deviation_percent = ((route_distance - distance_m) / distance_m) * 100
+                    
+                    within_tolerance = deviation <= tolerance_m
+                    status = "✓" if within_tolerance else ""
+                    attempts_info.append(
+                        f"GraphHopper variant {futures[future] + 1}: {route_distance/1000:.2f} km ({deviation_percent:+.1f}%) {status}"
+                    )
+                    
+                    if within_tolerance:
+                        if not found_within_tolerance or deviation < best_deviation:
+                            found_within_tolerance = True
                             best_deviation = deviation
                             best_route = data
-                            
-            except Exception as e:
-                st.warning(f"GraphHopper fel: {str(e)}")
-                continue
-        
-        # Visa resultat endast om debug mode
-        if attempts_info and st.checkbox("Visa debug", value=False, key="debug_gh"):
-            with st.expander(f"GraphHopper testade {len(attempts_info)} varianter", expanded=False):
-                for info in attempts_info:
-                    st.text(info)
-                if found_within_tolerance:
-                    st.success(f"Hittade rutt inom tolerans ({tolerance_percent}%)")
-                else:
-                    st.info("Ingen rutt inom tolerans hittades")
+                        if abs(deviation_percent) <= PERFECT_TOLERANCE_PERCENT:
+                            break
+                    elif not found_within_tolerance and deviation < best_deviation:
+                        best_deviation = deviation
+                        best_route = data
+        finally:
+            abort.set()
+            executor.shutdown(wait=False, cancel_futures=True)
         
         if best_route:
-            return self._parse_graphhopper_response(best_route)
+            route = self._parse_graphhopper_response(best_route, pace_seconds)
+            if route:
+                # Försöken följer med rutten och visas i huvudtråden vid debugläge
+                route.attempts = attempts_info
+                route.within_tolerance = found_within_tolerance
+            return route
         
         return None
     
+    def _get_json(
+        self,
+        url: str,
+        params: dict,
+        abort: Optional[threading.Event] = None
+    ) -> Optional[dict]:
+        """GET mot GraphHopper, None om svaret inte är 200 eller sökningen avbrutits"""
+        if abort is not None and abort.is_set():
+            return None
+        with _GH.get(url, params=params, stream=True) as response:
+            if response.status_code == 200 and not (abort is not None and abort.is_set()):
+                return _json.loads(response.content)
+        return None
+    
     def _get_point_to_point(
         self,
         start: Tuple[float, float],
         end: Tuple[float, float],
-        surface_preference: str = "any"
+        surface_preference: str = "any",
+        pace_seconds: int = 330
     ) -> Optional[RouteInfo]:
         """Hämta point-to-point rutt från GraphHopper med underlagsval"""
         
@@ -430,6 +515,7 @@ class GraphHopperProvider(RoutingProvider):
             "vehicle": vehicle,
             "elevation": "true",
             "points_encoded": "false",
+            "instructions": "false",
             "locale": "sv"
         }
         
@@ -452,15 +538,15 @@ class GraphHopperProvider(RoutingProvider):
             }
         
         try:
-            response = requests.get(url, params=params, timeout=30)
+            response = _GH.get(url, params=params)
             if response.status_code == 200:
-                return self._parse_graphhopper_response(response.json())
+                return self._parse_graphhopper_response(_json.loads(response.content), pace_seconds)
         except Exception:
             pass
         
         return None
     
-    def _parse_graphhopper_response(self, data: dict) -> Optional[RouteInfo]:
+    def _parse_graphhopper_response(self, data: dict, pace_seconds: int) -> Optional[RouteInfo]:
         """Parsa GraphHopper-respons till RouteInfo"""
         
         if "paths" not in data or not data["paths"]:
@@ -472,37 +558,27 @@ class GraphHopperProvider(RoutingProvider):
         if "coordinates" not in points_data:
             return None
         
+        # GraphHopper format: [lon, lat, elevation]
         coordinates = points_data["coordinates"]
-        points = []
-        
-        for coord in coordinates:
-            if len(coord) >= 2:
-                # GraphHopper format: [lon, lat, elevation]
-                elevation = coord[2] if len(coord) > 2 else None
-                points.append(RoutePoint(
-                    lat=coord[1],
-                    lon=coord[0],
-                    elevation=elevation
-                ))
+        lats, lons, elevations = coordinates_to_arrays(coordinates)
         
         distance = path.get("distance", 0)
         ascend = path.get("ascend", 0)
-        elevation_gain = ascend if ascend > 0 else calculate_elevation_gain(points)
+        elevation_gain = ascend if ascend > 0 else calculate_elevation_gain(elevations)
         
         # GraphHopper ger tid i millisekunder
         time_ms = path.get("time", 0)
         if time_ms > 0:
-            estimated_time = timedelta(milliseconds=time_ms)
+            estimated_seconds = int(time_ms // 1000)
         else:
-            pace_min = parse_pace(st.session_state.get("pace", "5:30"))
-            time_minutes = (distance / 1000) * pace_min
-            estimated_time = timedelta(minutes=time_minutes)
+            estimated_seconds = int(distance * pace_seconds / 1000)
         
         return RouteInfo(
-            points=points,
+            lats=lats,
+            lons=lons,
+            elevations=elevations,
             distance=distance,
             elevation_gain=elevation_gain,
-            estimated_time=estimated_time,
-            geometry=coordinates,
+            estimated_seconds=estimated_seconds,
             provider="GraphHopper"
         )
\ No newline at end of file
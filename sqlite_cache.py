@@ -0,0 +1,32 @@
+"""
+Delad SQLite-anslutning för de persistenta cacharna
+"""
+
+import sqlite3
+import threading
+from typing import Optional
+
+class SharedConnection:
+    """
+    En delad anslutning per databasfil och process, öppnas vid första användning
+    
+    Anslutningen används från flera trådar, så all åtkomst ska gå via lock.
+    """
+    
+    def __init__(self, path: str, *schema: str):
+        self._path = path
+        self._schema = schema
+        self._conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+    
+    def connect(self) -> sqlite3.Connection:
+        """Hämta anslutningen, öppna databasen och skapa tabellerna vid behov (kräver lock)"""
+        if self._conn is not None:
+            return self._conn
+        conn = sqlite3.connect(self._path, check_same_thread=False)
+        # WAL låter läsare och skrivare i andra processer arbeta samtidigt
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in self._schema:
+            conn.execute(statement)
+        self._conn = conn
+        return conn
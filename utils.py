@@ -3,65 +3,144 @@ Hjälpfunktioner för löparruttplaneraren
 """
 
 import math
-import gpxpy
-import gpxpy.gpx
-from typing import List, Tuple
-from datetime import datetime
-from models import RoutePoint, RouteInfo
+import re
+from functools import lru_cache
+import numpy as np
+from xml.sax.saxutils import escape
+from typing import Iterator, List, Tuple
+from datetime import datetime, timedelta, timezone
+from models import RouteInfo
+from geo_kernels import haversine_total
 
-def calculate_elevation_gain(points: List[RoutePoint]) -> float:
+# Tempo som "5:30", med valfria mellanslag runt
+_PACE_RE = re.compile(r"^\s*(\d+):(\d{1,2})\s*$")
+
+# Kompassriktningar i medurs ordning med start i norr
+_COMPASS_DIRECTIONS = ("N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
+                       "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW")
+
+def coordinates_to_arrays(coordinates: List[List[float]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Dela upp [lon, lat(, elevation)]-koordinater i kolumnarrayer
+    
+    Används av båda providers. Enhetlig geometri konverteras med ett enda
+    np.asarray-anrop; punkter utan höjd får NaN.
+    
+    Args:
+        coordinates: GeoJSON-koordinater som [lon, lat] eller [lon, lat, elevation]
+    
+    Returns:
+        (lats, lons, elevations) som float64-arrayer
+    """
+    try:
+        arr = np.asarray(coordinates, dtype=np.float64)
+    except ValueError:
+        # Blandat 2D/3D: fyll en förallokerad array
+        arr = np.full((len(coordinates), 3), np.nan)
+        n = 0
+        for coord in coordinates:
+            if len(coord) >= 2:
+                width = min(len(coord), 3)
+                arr[n, :width] = coord[:width]
+                n += 1
+        arr = arr[:n]
+    if arr.ndim != 2 or arr.shape[1] < 2:
+        arr = np.empty((0, 3), dtype=np.float64)
+    
+    lats = np.ascontiguousarray(arr[:, 1])
+    lons = np.ascontiguousarray(arr[:, 0])
+    if arr.shape[1] > 2:
+        elevations = np.ascontiguousarray(arr[:, 2])
+    else:
+        elevations = np.full(len(arr), np.nan)
+    return lats, lons, elevations
+
+def calculate_elevation_gain(elevations: np.ndarray) -> float:
     """
     Beräkna total höjdökning
     
     Args:
-        points: Lista med RoutePoint
+        elevations: Höjd per punkt i meter, NaN där höjd saknas
     
     Returns:
         Total höjdökning i meter
     """
-    if not points or not any(p.elevation for p in points):
+    # Punkter utan höjd hoppas över så att stigningen över en lucka räknas
+    known = _known_elevations(elevations)
+    if len(known) < 2:
         return 0.0
+    return float(np.clip(np.diff(known), 0, None).sum())
+
+def _known_elevations(elevations: np.ndarray) -> np.ndarray:
+    """Höjdvärden utan NaN; kopierar bara när några punkter faktiskt saknar höjd"""
+    missing = np.isnan(elevations)
+    if not missing.any():
+        return elevations
+    if missing.all():
+        return elevations[:0]
+    return elevations[~missing]
+
+def calculate_distance_from_points(lats: np.ndarray, lons: np.ndarray) -> float:
+    """
+    Beräkna total distans längs en rutt (Haversine formula)
     
-    total_gain = 0.0
-    prev_elevation = None
+    Args:
+        lats: Latituder i grader
+        lons: Longituder i grader
+    
+    Returns:
+        Total distans i meter
+    """
+    if len(lats) < 2:
+        return 0
     
-    for point in points:
-        if point.elevation is not None:
-            if prev_elevation is not None and point.elevation > prev_elevation:
-                total_gain += point.elevation - prev_elevation
-            prev_elevation = point.elevation
+    # Kompilerad kärna om numba finns
+    if haversine_total is not None:
+        return float(haversine_total(
+            np.ascontiguousarray(lats, dtype=np.float64),
+            np.ascontiguousarray(lons, dtype=np.float64)
+        ))
     
-    return total_gain
+    # Annars beräknas hela rutten i en vektoriserad passage istället för per punkt
+    return float(segment_distances(lats, lons).sum())
 
-def calculate_distance_from_points(points: List[RoutePoint]) -> float:
+def segment_distances(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
     """
-    Beräkna total distans från en lista av punkter (Haversine formula)
+    Beräkna längden på varje segment mellan på varandra följande punkter
     
     Args:
-        points: Lista med RoutePoint
+        lats: Latituder i grader
+        lons: Longituder i grader
     
     Returns:
-        Total distans i meter
+        Segmentlängder i meter (en kortare än antalet punkter)
     """
-    if len(points) < 2:
-        return 0
+    lats = np.radians(lats)
+    lat1, lat2 = lats[:-1], lats[1:]
+    dlat = lat2 - lat1
+    dlon = np.radians(np.diff(lons))
     
-    total_distance = 0
-    for i in range(len(points) - 1):
-        lat1, lon1 = math.radians(points[i].lat), math.radians(points[i].lon)
-        lat2, lon2 = math.radians(points[i+1].lat), math.radians(points[i+1].lon)
-        
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-        
-        a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-        c = 2 * math.asin(math.sqrt(a))
-        
-        # Jordens radie i meter
-        r = 6371000
-        total_distance += r * c
+    a = np.sin(dlat * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon * 0.5) ** 2
     
-    return total_distance
+    # Jordens diameter i meter, 2 * radien
+    return (2 * 6371000) * np.arcsin(np.sqrt(a))
+
+@lru_cache(maxsize=64)
+def parse_pace_seconds(pace_str: str) -> int:
+    """
+    Konvertera tempo-sträng till sekunder per km
+    
+    Args:
+        pace_str: Tempo som "5:30"
+    
+    Returns:
+        Sekunder per km
+    """
+    m = _PACE_RE.match(pace_str or "")
+    if not m:
+        return 330  # Default 5:30
+    minutes, seconds = m.groups()
+    return int(minutes) * 60 + int(seconds)
 
 def parse_pace(pace_str: str) -> float:
     """
@@ -73,20 +152,15 @@ def parse_pace(pace_str: str) -> float:
     Returns:
         Minuter per km
     """
-    try:
-        parts = pace_str.split(":")
-        if len(parts) == 2:
-            minutes = int(parts[0])
-            seconds = int(parts[1])
-            return minutes + seconds / 60
-    except:
-        pass
-    return 5.5  # Default
+    return parse_pace_seconds(pace_str) / 60
 
 def create_gpx(route_info: RouteInfo, name: str = "Löprunda") -> str:
     """
     Skapa GPX-fil från ruttinformation
     
+    Skriver XML direkt från ruttens arrayer istället för att bygga upp ett
+    objektträd per punkt.
+    
     Args:
         route_info: RouteInfo-objekt
         name: Namn på rutten
@@ -94,37 +168,78 @@ def create_gpx(route_info: RouteInfo, name: str = "Löprunda") -> str:
     Returns:
         GPX som sträng
     """
-    gpx = gpxpy.gpx.GPX()
-    
-    # Lägg till metadata
-    gpx.creator = "Löparruttplanerare"
-    gpx.description = f"Genererad löprunda på {route_info.distance/1000:.2f} km"
-    
-    # Skapa track
-    gpx_track = gpxpy.gpx.GPXTrack()
-    gpx_track.name = name
-    gpx_track.type = "running"
-    gpx.tracks.append(gpx_track)
-    
-    # Skapa segment
-    gpx_segment = gpxpy.gpx.GPXTrackSegment()
-    gpx_track.segments.append(gpx_segment)
-    
-    # Lägg till punkter
-    for point in route_info.points:
-        gpx_point = gpxpy.gpx.GPXTrackPoint(
-            point.lat, 
-            point.lon,
-            elevation=point.elevation,
-            time=datetime.now()  # Kan förbättras med faktisk tidsstämpel
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n',
+        '<gpx xmlns="http://www.topografix.com/GPX/1/1" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" '
+        'version="1.1" creator="Löparruttplanerare">\n',
+        # Metadata
+        "  <metadata>\n",
+        f"    <desc>Genererad löprunda på {route_info.distance/1000:.2f} km</desc>\n",
+        "  </metadata>\n",
+        # Track med statistik
+        "  <trk>\n",
+        f"    <name>{escape(name)}</name>\n",
+    ]
+    if route_info.elevation_gain > 0:
+        parts.append(
+            f"    <desc>Höjdökning: {route_info.elevation_gain:.0f}m, "
+            f"Uppskattad tid: {format_duration(route_info.estimated_seconds)}</desc>\n"
         )
-        gpx_segment.points.append(gpx_point)
+    parts.append("    <type>running</type>\n")
+    parts.append("    <trkseg>\n")
     
-    # Lägg till statistik som extensions
-    if route_info.elevation_gain > 0:
-        gpx_track.description = f"Höjdökning: {route_info.elevation_gain:.0f}m, Uppskattad tid: {route_info.estimated_time}"
+    # Lägg till punkter, en färdig sträng per punkt
+    parts.extend(_trkpt_lines(route_info))
     
-    return gpx.to_xml()
+    parts.append("    </trkseg>\n")
+    parts.append("  </trk>\n")
+    parts.append("</gpx>")
+    
+    return "".join(parts)
+
+def _trkpt_lines(route_info: RouteInfo) -> Iterator[str]:
+    """Generera ett komplett trkpt-element per punkt i rutten"""
+    # Tidsstämplar fördelas längs rutten efter avverkad distans, så att
+    # spåret ser ut som en verklig löptur med den uppskattade tiden
+    # GPX-tider skrivs i UTC med Z-suffix, som klockor och Strava förväntar sig
+    start = datetime.now(timezone.utc)
+    offsets = _time_offsets(route_info)
+    
+    for lat, lon, elevation, offset in zip(
+        route_info.lats.tolist(), route_info.lons.tolist(),
+        route_info.elevations.tolist(), offsets.tolist()
+    ):
+        time = (start + timedelta(seconds=offset)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        if elevation == elevation:  # NaN saknar höjd
+            yield (
+                f'      <trkpt lat="{lat:.6f}" lon="{lon:.6f}">\n'
+                f"        <ele>{elevation:.1f}</ele>\n"
+                f"        <time>{time}</time>\n"
+                "      </trkpt>\n"
+            )
+        else:
+            yield (
+                f'      <trkpt lat="{lat:.6f}" lon="{lon:.6f}">\n'
+                f"        <time>{time}</time>\n"
+                "      </trkpt>\n"
+            )
+
+def _time_offsets(route_info: RouteInfo) -> np.ndarray:
+    """Sekunder från start till varje punkt, proportionellt mot avverkad distans"""
+    n = len(route_info.lats)
+    if n < 2 or route_info.estimated_seconds <= 0:
+        return np.zeros(n)
+    
+    cumulative = np.empty(n)
+    cumulative[0] = 0.0
+    np.cumsum(segment_distances(route_info.lats, route_info.lons), out=cumulative[1:])
+    
+    total = cumulative[-1]
+    if total <= 0:
+        return np.zeros(n)
+    return cumulative * (route_info.estimated_seconds / total)
 
 def calculate_via_points(
     start: Tuple[float, float], 
@@ -159,16 +274,13 @@ def calculate_via_points(
     lat_offset = radius / 111000  # ~111km per latitudgrad
     lon_offset = radius / (111000 * math.cos(math.radians(mid_lat)))
     
-    via_points = []
-    
-    # Testa olika vinklar
-    for angle in [0, 90, 180, 270]:
-        rad = math.radians(angle)
-        via_lat = mid_lat + lat_offset * math.sin(rad)
-        via_lon = mid_lon + lon_offset * math.cos(rad)
-        via_points.append((via_lat, via_lon))
-    
-    return via_points
+    # Testa fyra vinklar (0°, 90°, 180°, 270°); sin/cos blir där bara 0 eller ±1
+    return [
+        (mid_lat, mid_lon + lon_offset),
+        (mid_lat + lat_offset, mid_lon),
+        (mid_lat, mid_lon - lon_offset),
+        (mid_lat - lat_offset, mid_lon),
+    ]
 
 def format_time(minutes: float) -> str:
     """
@@ -189,6 +301,20 @@ def format_time(minutes: float) -> str:
     else:
         return f"{mins:02d}:{secs:02d}"
 
+def format_duration(seconds: int) -> str:
+    """
+    Formatera tid från sekunder till sträng
+    
+    Args:
+        seconds: Antal sekunder
+    
+    Returns:
+        Formaterad tidssträng (H:MM:SS)
+    """
+    hours, rest = divmod(int(seconds), 3600)
+    mins, secs = divmod(rest, 60)
+    return f"{hours}:{mins:02d}:{secs:02d}"
+
 def calculate_bearing(point1: Tuple[float, float], point2: Tuple[float, float]) -> float:
     """
     Beräkna bäring mellan två punkter
@@ -224,10 +350,52 @@ def get_compass_direction(bearing: float) -> str:
     Returns:
         Kompassriktning (N, NE, E, etc.)
     """
-    directions = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
-                  "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
-    index = int((bearing + 11.25) / 22.5) % 16
-    return directions[index]
+    # 16 sektorer à 22,5°; avrundning och & 15 ger samma index som (b + 11,25) / 22,5 % 16
+    return _COMPASS_DIRECTIONS[int(bearing * (16 / 360) + 0.5) & 15]
+
+def simplify_points(lats: np.ndarray, lons: np.ndarray, epsilon: float = 1e-5) -> np.ndarray:
+    """
+    Förenkla en rutt med Ramer-Douglas-Peucker för visning på kartan
+    
+    Args:
+        lats: Latituder i grader
+        lons: Longituder i grader
+        epsilon: Största tillåtna avvikelse i grader (1e-5 ≈ 1 m)
+    
+    Returns:
+        Index för de punkter som behålls, i ursprunglig ordning
+    """
+    if len(lats) < 3:
+        return np.arange(len(lats))
+    
+    coords = np.column_stack([lons, lats])
+    keep = np.zeros(len(coords), dtype=bool)
+    keep[0] = keep[-1] = True
+    
+    # Iterativ variant för att undvika djup rekursion på långa rutter
+    stack = [(0, len(coords) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        
+        seg = coords[last] - coords[first]
+        rel = coords[first + 1:last] - coords[first]
+        seg_len = math.hypot(seg[0], seg[1])
+        if seg_len == 0:
+            # Slutna slingor: avstånd till startpunkten
+            dists = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            dists = np.abs(seg[0] * rel[:, 1] - seg[1] * rel[:, 0]) / seg_len
+        
+        idx = int(np.argmax(dists))
+        if dists[idx] > epsilon:
+            mid = first + 1 + idx
+            keep[mid] = True
+            stack.append((first, mid))
+            stack.append((mid, last))
+    
+    return np.flatnonzero(keep)
 
 def validate_coordinates(lat: float, lon: float) -> bool:
     """
@@ -259,22 +427,19 @@ def get_route_statistics(route_info: RouteInfo) -> dict:
         "elevation_loss": 0,
         "max_elevation": None,
         "min_elevation": None,
-        "estimated_time": route_info.estimated_time,
-        "num_points": len(route_info.points),
+        "estimated_seconds": route_info.estimated_seconds,
+        "num_points": len(route_info.lats),
         "provider": route_info.provider
     }
     
     # Beräkna höjdstatistik
-    elevations = [p.elevation for p in route_info.points if p.elevation is not None]
-    if elevations:
-        stats["max_elevation"] = max(elevations)
-        stats["min_elevation"] = min(elevations)
+    known = _known_elevations(route_info.elevations)
+    if len(known):
+        stats["max_elevation"] = float(known.max())
+        stats["min_elevation"] = float(known.min())
         
         # Beräkna höjdförlust
-        prev_elevation = None
-        for elevation in elevations:
-            if prev_elevation is not None and elevation < prev_elevation:
-                stats["elevation_loss"] += prev_elevation - elevation
-            prev_elevation = elevation
+        diffs = np.diff(known)
+        stats["elevation_loss"] = float(np.clip(-diffs, 0, None).sum())
     
     return stats
\ No newline at end of file